@@ -1,4 +1,4 @@
-from setuptools import setup, find_packages
+from setuptools import setup
 
 requirements = [
     'jupyter-server-proxy>=1.5',
@@ -8,8 +8,9 @@ requirements = [
     'aiohttp-cors>=0.7',
     'pydeck>=0.5',
     'mercantile>=1',
+    'numba>=0.50',
     'affine>=2',
-    'pillow>=7'
+    'imagecodecs'
 ]
 
 setup(
@@ -34,10 +35,10 @@ setup(
     include_package_data=True,
     keywords='xtrude',
     name='xtrude',
-    packages=find_packages(include=['xtrude', 'xtrude.*']),
+    packages=['xtrude'],
     setup_requires=[],
     tests_require=[],
     url='https://github.com/davidbrochart/xtrude',
     version='0.1.2',
-    zip_safe=False
+    zip_safe=True
 )
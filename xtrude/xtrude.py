@@ -1,5 +1,9 @@
 import asyncio
-from io import BytesIO
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import os
+import threading
 import warnings
 
 from aiohttp import web
@@ -8,13 +12,41 @@ import xarray as xr
 import pydeck as pdk
 from ipywidgets import Output
 from traitlets import HasTraits, Bool, observe
+import imagecodecs
 import ipyspin
 import mercantile
-from PIL import Image
 import numpy as np
-from rasterio.warp import Resampling
+from numba import njit, prange
+from rasterio.crs import CRS
+from rasterio.warp import Resampling, reproject as warp_reproject
+import rioxarray
 from affine import Affine
 
+try:
+    import uvloop
+except ImportError:
+    pass
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+# the tile CRS never changes, parse it once instead of once per warp
+WEB_MERCATOR = CRS.from_epsg(3857)
+
+
+@njit(parallel=True)
+def _apply_lut(data, vmin, scale, lut, out):
+    n = lut.shape[0]
+    for i in prange(data.shape[0]):
+        for j in range(data.shape[1]):
+            idx = int((data[i, j] - vmin) * scale)
+            if idx < 0:
+                idx = 0
+            elif idx >= n:
+                idx = n - 1
+            out[i, j, 0] = lut[idx, 0]
+            out[i, j, 1] = lut[idx, 1]
+            out[i, j, 2] = lut[idx, 2]
+
 
 @xr.register_dataarray_accessor('xtrude')
 class TerrainMap(HasTraits):
@@ -31,6 +63,17 @@ class TerrainMap(HasTraits):
     def __init__(self, da):
         self.da = da
 
+    @contextmanager
+    def _maybe_debug(self):
+        # capturing output through the widget replaces sys.stdout/stderr and
+        # flushes comm messages on exit, which is too expensive for the
+        # per-request paths; only pay for it when a debug output was passed
+        if self._debug:
+            with self.debug_output:
+                yield
+        else:
+            yield
+
     def plot(self,
              x_dim='x',
              y_dim='y',
@@ -53,6 +96,7 @@ class TerrainMap(HasTraits):
             self.debug_output = Output()
         else:
             self.debug_output = debug_output
+        self._debug = debug_output is not None
 
         with self.debug_output:
             self.terrain_port = terrain_port or 8080
@@ -75,12 +119,40 @@ class TerrainMap(HasTraits):
             self.surface_url = surface_url
             self.colormap = colormap
             self.tiles = {}
+            # LRU cache of the final encoded PNGs, so that repeat requests
+            # for the same tile are served without any compute
+            self.png_cache = OrderedDict()
+            self.png_cache_size = 512
+            # per-thread scratch buffer for the terrain RGB tile, allocated
+            # once and reused across requests
+            self.rgb_scratch = threading.local()
+            # reprojection is CPU-bound and holds the GIL, so compute tiles
+            # in worker processes to serve concurrent requests in parallel;
+            # shut down the previous pool when plot() is re-run, so its
+            # workers don't leak
+            pool = getattr(self, 'pool', None)
+            if pool is not None:
+                pool.shutdown(wait=False)
+            self.pool = ProcessPoolExecutor(max_workers=os.cpu_count())
             self.da = self.da.rename({y_dim: 'y', x_dim: 'x'})
-
-            # ensure latitudes are descending
-            if np.any(np.diff(self.da.y.values) >= 0):
+            # float32 is plenty for elevations in meters, and halves the
+            # memory traffic through coarsen/reproject/colormap
+            self.da = self.da.astype(np.float32, copy=False)
+
+            # ensure latitudes are descending (coordinates are monotonic, so
+            # comparing the endpoints is enough)
+            y_vals = self.da.y.values
+            if y_vals.size > 1 and y_vals[0] < y_vals[-1]:
                 self.da = self.da.sel(y=slice(None, None, -1))
 
+            # reduce over the whole array now, rather than lazily in the
+            # handlers where it would block the event loop
+            if self.colormap is not None:
+                if self.vmin is None:
+                    self.vmin = float(self.da.min().values)
+                if self.vmax is None:
+                    self.vmax = float(self.da.max().values)
+
             # infer grid specifications (assume a rectangular grid)
             y = self.da.y.values
             x = self.da.x.values
@@ -93,6 +165,15 @@ class TerrainMap(HasTraits):
             self.dx = float((self.x_right - self.x_left) / (x.size - 1))
             self.dy = float((self.y_upper - self.y_lower) / (y.size - 1))
 
+            self.src_crs = self.da.rio.crs
+            self.src_nodata = self.da.rio.nodata
+            # LRU cache of 512x512 source blocks: neighboring tiles overlap
+            # in their source windows, so panning reuses blocks instead of
+            # re-reading the same rows
+            self.src_blocks = OrderedDict()
+            self.src_blocks_size = 16
+            self.src_block_width = 512
+
             self.l = pdk.Layer("TerrainLayer", data=None, elevation_decoder=None, elevation_data=None, texture=None)
 
             return self.l
@@ -116,6 +197,17 @@ class TerrainMap(HasTraits):
             if self.colormap is None:
                 surface_url = self.surface_url
             else:
+                # bake the colormap into an RGB lookup table with one entry
+                # per meter of elevation range (at least 256 so low-relief
+                # DEMs keep full color resolution, capped at 65536), so that
+                # the handlers never call back into matplotlib
+                span = self.vmax - self.vmin
+                n = min(65536, max(int(np.ceil(span)) + 1, 256))
+                self._lut = (self.colormap(np.linspace(0, 1, n))[:, :3] * 255).astype(np.uint8)
+                self._lut_scale = (n - 1) / span
+                # compile the kernel now, so the first surface tile doesn't
+                # stall the event loop on the JIT
+                _apply_lut(np.zeros((1, 1), dtype=np.float32), self.vmin, self._lut_scale, self._lut, np.empty((1, 1, 3), dtype=np.uint8))
                 self.start_server(self.surface_port, self.surface_handler)
                 surface_url = f'{base_url}/proxy/127.0.0.1:{self.surface_port}' + '/{z}/{x}/{y}.png'
             terrain_url = f'{base_url}/proxy/127.0.0.1:{self.terrain_port}' + '/{z}/{x}/{y}.png'
@@ -127,68 +219,114 @@ class TerrainMap(HasTraits):
 
 
     async def surface_handler(self, request):
-        with self.debug_output:
-            z, x, y = str(request.url).split('/')[-3:]
-            z = int(z)
-            x = int(x)
-            y = int(y[:-4])  # remove ".png"
-
-            if self.vmin is None:
-                self.vmin = self.da.min().values
-            if self.vmax is None:
-                self.vmax = self.da.max().values
-            data = (self.get_tile(x, y, z) - self.vmin) / (self.vmax - self.vmin)
-            rgb = self.colormap(data)[:, :, :3] * 255
-            image = Image.fromarray(rgb.astype(np.uint8))
-            with BytesIO() as f:
-                image.save(f, format='PNG')
-                return web.Response(body=f.getvalue(), status=200, content_type="image/png")
+        with self._maybe_debug():
+            z = int(request.match_info['z'])
+            x = int(request.match_info['x'])
+            y = int(request.match_info['y'])
+
+            key = ('surface', z, x, y)
+            body = self.png_cache.get(key)
+            if body is None:
+                data = await self.get_tile(x, y, z)
+                rgb = np.empty((self.tile_width, self.tile_width, 3), dtype=np.uint8)
+                _apply_lut(data, self.vmin, self._lut_scale, self._lut, rgb)
+                body = imagecodecs.png_encode(rgb, level=1)
+                self.png_cache[key] = body
+                if len(self.png_cache) > self.png_cache_size:
+                    self.png_cache.popitem(last=False)
+            else:
+                self.png_cache.move_to_end(key)
+            return web.Response(body=body, status=200, content_type="image/png")
 
     async def terrain_handler(self, request):
-        with self.debug_output:
-            z, x, y = str(request.url).split('/')[-3:]
-            z = int(z)
-            x = int(x)
-            y = int(y[:-4])  # remove ".png"
-
-            data = self.get_tile(x, y, z)
-            data = (data + self.offset) * self.factor
-            rgb = np.empty((self.tile_width, self.tile_width, 3), dtype=np.uint8)
-            rgb[:, :, 2] = data % 256
-            rgb[:, :, 1] = (data // 256) % 256
-            rgb[:, :, 0] = (data // (256 * 256)) % 256
-            image = Image.fromarray(rgb)
-            with BytesIO() as f:
-                image.save(f, format='PNG')
-                return web.Response(body=f.getvalue(), status=200, content_type="image/png")
+        with self._maybe_debug():
+            z = int(request.match_info['z'])
+            x = int(request.match_info['x'])
+            y = int(request.match_info['y'])
+
+            key = ('terrain', z, x, y)
+            body = self.png_cache.get(key)
+            if body is None:
+                data = await self.get_tile(x, y, z)
+                # the addition allocates the working copy (the cached tile
+                # must not be mutated), the scaling is done in place
+                data = data + self.offset
+                data *= self.factor
+                # reinterpret the big-endian uint32 values as bytes: bytes 1, 2, 3
+                # are the R, G, B channels of the 24-bit encoded elevation
+                d32 = np.ascontiguousarray(data, dtype='>u4')
+                bytes4 = d32.view(np.uint8).reshape(self.tile_width, self.tile_width, 4)
+                rgb = getattr(self.rgb_scratch, 'rgb', None)
+                if rgb is None:
+                    rgb = np.empty((self.tile_width, self.tile_width, 3), dtype=np.uint8)
+                    self.rgb_scratch.rgb = rgb
+                np.copyto(rgb, bytes4[:, :, 1:4])
+                body = imagecodecs.png_encode(rgb, level=1)
+                self.png_cache[key] = body
+                if len(self.png_cache) > self.png_cache_size:
+                    self.png_cache.popitem(last=False)
+            else:
+                self.png_cache.move_to_end(key)
+            return web.Response(body=body, status=200, content_type="image/png")
 
 
     def start_server(self, port, handler):
         app = web.Application()
 
         cors = aiohttp_cors.setup(app)
-        resource = cors.add(app.router.add_resource('/{z}/{x}/{y}.png'))
+        resource = cors.add(app.router.add_resource(r'/{z:\d+}/{x:\d+}/{y:\d+}.png'))
         cors.add(resource.add_route("GET", handler), {"*": aiohttp_cors.ResourceOptions(expose_headers="*", allow_headers="*")})
 
-        asyncio.ensure_future(web._run_app(app, host='127.0.0.1', port=port))
+        asyncio.ensure_future(self.serve(app, port))
 
 
-    def get_tile(self, x, y, z):
-        with self.debug_output:
+    async def serve(self, app, port):
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', port)
+        await site.start()
+
+
+    async def get_tile(self, x, y, z):
+        with self._maybe_debug():
             key = (x, y, z)
             if key not in self.tiles:
-                tile = mercantile.Tile(x, y, z)
-                bounds = mercantile.bounds(tile)
-                xy_bounds = mercantile.xy_bounds(tile)
-                x_pix = (xy_bounds.right - xy_bounds.left) / self.tile_width
-                y_pix = (xy_bounds.top - xy_bounds.bottom) / self.tile_width
-                da_tile = self.da.sel(y=slice(bounds.north + self.dy, bounds.south - self.dy), x=slice(bounds.west - self.dx, bounds.east + self.dx))
-                da_tile = coarsen(da_tile, self.tile_width)
-                data = reproject(da_tile, xy_bounds.left, xy_bounds.top, x_pix, y_pix, self.tile_width)
+                bounds = mercantile.bounds(mercantile.Tile(x, y, z))
+                iy0 = max(0, int(np.ceil((self.y_upper - bounds.north - self.dy) / self.dy)))
+                iy1 = min(self.da.y.size, int(np.floor((self.y_upper - bounds.south + self.dy) / self.dy)) + 1)
+                ix0 = max(0, int(np.ceil((bounds.west - self.dx - self.x_left) / self.dx)))
+                ix1 = min(self.da.x.size, int(np.floor((bounds.east + self.dx - self.x_left) / self.dx)) + 1)
+                source, src_transform = self.get_window(iy0, iy1, ix0, ix1)
+                loop = asyncio.get_running_loop()
+                data = await loop.run_in_executor(self.pool, compute_tile, source, src_transform, self.src_crs, self.src_nodata, x, y, z, self.tile_width)
                 self.tiles[key] = data
             return self.tiles[key]
 
 
+    def get_window(self, iy0, iy1, ix0, ix1):
+        bw = self.src_block_width
+        rows = []
+        for by in range(iy0 // bw, (iy1 - 1) // bw + 1):
+            cols = []
+            for bx in range(ix0 // bw, (ix1 - 1) // bw + 1):
+                blk = self.src_blocks.get((by, bx))
+                if blk is None:
+                    blk = self.da.isel(y=slice(by * bw, (by + 1) * bw), x=slice(bx * bw, (bx + 1) * bw)).values
+                    self.src_blocks[(by, bx)] = blk
+                    if len(self.src_blocks) > self.src_blocks_size:
+                        self.src_blocks.popitem(last=False)
+                else:
+                    self.src_blocks.move_to_end((by, bx))
+                cols.append(blk)
+            rows.append(np.concatenate(cols, axis=1) if len(cols) > 1 else cols[0])
+        window = np.concatenate(rows, axis=0) if len(rows) > 1 else rows[0]
+        oy = (iy0 // bw) * bw
+        ox = (ix0 // bw) * bw
+        window = window[iy0 - oy:iy1 - oy, ix0 - ox:ix1 - ox]
+        src_transform = Affine(self.dx, 0, self.x_left - self.dx / 2 + ix0 * self.dx, 0, -self.dy, self.y_upper + self.dy / 2 - iy0 * self.dy)
+        return window, src_transform
+
+
     async def async_wait_for_window_url(self):
         with self.debug_output:
             if not self.s.window_url:
@@ -198,26 +336,40 @@ class TerrainMap(HasTraits):
             self.map_ready = True
 
 
-def coarsen(array, tile_width):
-    ny, nx = array.shape
-    wx = nx // (tile_width * 2)
-    wy = ny // (tile_width * 2)
-    dim = {}
-    if wx > 1:
-        dim['x'] = wx
-    if wy > 1:
-        dim['y'] = wy
-    try:
-        c = array.coarsen(**dim, boundary='pad')
-        with warnings.catch_warnings():
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            array = xr.core.rolling.DataArrayCoarsen.mean(c)
-    except:
-        pass
-    return array
-
-
-def reproject(source, x0, y0, x_res, y_res, tile_width):
+def compute_tile(source, src_transform, src_crs, src_nodata, x, y, z, tile_width):
+    tile = mercantile.Tile(x, y, z)
+    xy_bounds = mercantile.xy_bounds(tile)
+    x_pix = (xy_bounds.right - xy_bounds.left) / tile_width
+    y_pix = (xy_bounds.top - xy_bounds.bottom) / tile_width
+    ny, nx = source.shape
+    wx = max(nx // (tile_width * 2), 1)
+    wy = max(ny // (tile_width * 2), 1)
+    if wx > 1 or wy > 1:
+        source = block_mean(source, wy, wx)
+        src_transform = src_transform * Affine.scale(wx, wy)
+        # the block average already brought the source to within ~2x the
+        # tile resolution, so a nearest-neighbor sample is enough (and ~3x
+        # cheaper in the warp loop than a 4-tap bilinear)
+        resampling = Resampling.nearest
+    else:
+        resampling = Resampling.bilinear
+    source = np.ascontiguousarray(source)
+    return reproject(source, src_transform, src_crs, src_nodata, xy_bounds.left, xy_bounds.top, x_pix, y_pix, tile_width, resampling)
+
+
+def block_mean(values, wy, wx):
+    ny, nx = values.shape
+    pad_y = -ny % wy
+    pad_x = -nx % wx
+    if pad_y or pad_x:
+        values = np.pad(values, ((0, pad_y), (0, pad_x)), mode='edge')
+    blocks = values.reshape(values.shape[0] // wy, wy, values.shape[1] // wx, wx)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        return np.nanmean(blocks, axis=(1, 3))
+
+
+def reproject(source, src_transform, src_crs, src_nodata, x0, y0, x_res, y_res, tile_width, resampling=Resampling.bilinear):
     a = x_res
     b = 0
     c = x0
@@ -225,8 +377,19 @@ def reproject(source, x0, y0, x_res, y_res, tile_width):
     e = -y_res
     f = y0
     dst_affine = Affine(a, b, c, d, e, f)
-    destination = source.rio.reproject('EPSG:3857', transform=dst_affine, shape=(tile_width, tile_width), resampling=Resampling.bilinear)
-    return destination.values
+    destination = np.empty((tile_width, tile_width), dtype=source.dtype)
+    warp_reproject(
+        source,
+        destination,
+        src_transform=src_transform,
+        src_crs=src_crs,
+        src_nodata=src_nodata,
+        dst_transform=dst_affine,
+        dst_crs=WEB_MERCATOR,
+        dst_nodata=np.nan,
+        resampling=resampling,
+    )
+    return destination
 
 
 def wait_for_change(widget, value):